@@ -1,34 +1,40 @@
 import requests
-import os
+import orjson
 import sys
 
-dataset = sys.argv[1]
+datasets = sys.argv[1:]
 
 headers = {
-    "Accept-Encoding": "gzip, deflate, br",
     "Content-Type": "application/json",
     "Accept": "application/json",
     "Connection": "keep-alive",
     "DNT": "1",
     "Origin": "https://openneuro.org",
 }
+url = "https://openneuro.org/crn/graphql"
+timeout = 30
 
 query = """
-{
-    uploader {
-        name,
-        email
+query testq($id: ID!) {
+    dataset(id: $id) {
+        uploader {
+            name,
+            email
+        }
     }
 }
 """.replace("\n", "")
 
-data = ('{"query":"query testq{dataset(id: \\"%s\\") ' % dataset) + query + '}"}'
-response = requests.post("https://openneuro.org/crn/graphql", headers=headers, data=data)
-response = response.json()
 
-uploader = response["data"]["dataset"]["uploader"]
-name = uploader["name"]
-email = uploader["email"]
+def get_uploader(session, dataset_id):
+    data = orjson.dumps({"query": query, "variables": {"id": dataset_id}})
+    response = session.post(url, data=data, timeout=timeout)
+    return orjson.loads(response.content)["data"]["dataset"]["uploader"]
 
-print(name)
-print(email)
+
+session = requests.Session()
+session.headers.update(headers)
+for dataset in datasets:
+    uploader = get_uploader(session, dataset)
+    print(uploader["name"])
+    print(uploader["email"])
@@ -1,6 +1,10 @@
 import requests
-import os
-from datetime import datetime
+import orjson
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
 
 scan_dict = {
@@ -20,75 +24,88 @@ age_dict = {
     (51, 65): "51-65",
     (66, 1000): "66+",
 }
-bool_dict = {True: "yes", False: "no", None: "no"}
+age_lower_bounds = np.array([lower for lower, _ in age_dict])
+age_upper_bounds = np.array([upper for _, upper in age_dict])
+age_labels = list(age_dict.values())
+bool_dict = {True: "Yes", False: "No"}
 date_arg_format = "%Y-%m-%d"
 date_input_format = "%Y-%m-%d"
 date_output_format = "%Y-%m-%d"
 
 headers = {
-    "Accept-Encoding": "gzip, deflate, br",
     "Content-Type": "application/json",
     "Accept": "application/json",
     "Connection": "keep-alive",
     "DNT": "1",
     "Origin": "https://openneuro.org",
 }
+url = "https://openneuro.org/crn/graphql"
+dataset_url_template = "https://openneuro.org/datasets/{}/versions/{}"
+page_size = 100
+cursor_page_size = 100
+num_workers = 4
+timeout = 30
+num_attempts = 3
+backoff_factor = 0.5
+
+session = requests.Session()
+session.headers.update(headers)
+retries = Retry(
+    total=num_attempts,
+    backoff_factor=backoff_factor,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=["POST"],
+)
+session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=num_workers, max_retries=retries),
+)
 
 
 def format_modalities(all_modalities):
     modalities_available_list = []
-    if any(("MRI_" in e for e in all_modalities)):
-        all_modalities.remove("MRI")
-        for m in all_modalities:
-            if "MRI" in m:
-                scan_type = scan_dict[m.split("MRI_", 1)[1].lower()]
-                new_m = "MRI - " + scan_type
-                modalities_available_list.append(new_m)
-            else:
-                modalities_available_list.append(m)
+    has_mri_scan_type = False
+    for m in all_modalities:
+        if "MRI_" in m:
+            has_mri_scan_type = True
+            scan_type = scan_dict[m.split("MRI_", 1)[1].lower()]
+            new_m = "MRI - " + scan_type
+            modalities_available_list.append(new_m)
+        elif m != "MRI":
+            modalities_available_list.append(m)
+    if has_mri_scan_type:
+        return ", ".join(modalities_available_list)
     else:
-        modalities_available_list = all_modalities
-    return ", ".join(modalities_available_list)
+        return ", ".join(all_modalities)
 
 
 def format_ages(raw_age_list):
-    formatted_list = []
-    if raw_age_list:
-        age_list = sorted([x["age"] for x in raw_age_list if x["age"]])
-        for key, value in age_dict.items():
-            if any(x for x in age_list if x >= key[0] and x <= key[1]):
-                formatted_list.append(value)
-        return ", ".join(formatted_list)
-    else:
+    if not raw_age_list:
         return ""
+    ages = [x["age"] for x in raw_age_list if x.get("age")]
+    if not ages:
+        return ""
+    ages = np.array(ages, dtype=float)
+    buckets = np.searchsorted(age_upper_bounds, ages)
+    in_range = buckets < len(age_labels)
+    ages, buckets = ages[in_range], buckets[in_range]
+    buckets = buckets[ages >= age_lower_bounds[buckets]]
+    return ", ".join(age_labels[i] for i in np.unique(buckets))
 
 
 def format_name(name):
     if not name:
         return ""
-    elif "," not in name:
-        last = name.split(" ")[-1]
-        first = " ".join(name.split(" ")[0:-1])
-        new_name = last + ", " + first
-        return new_name
-    else:
+    elif "," in name:
         return name
-        
-def code_bool(parent, field):
-    if field in parent:
-        if parent[field]:
-            return "Yes"
-        elif parent[field] is False:
-            return "No"
-        elif parent[field] is None:
-            return "n/a"
     else:
-        return "n/a"
+        parts = name.split(" ")
+        return parts[-1] + ", " + " ".join(parts[:-1])
+
 
 query = """
 {
     edges {
-        cursor,
         node {
             id,
             publishDate,
@@ -122,110 +139,71 @@ query = """
                     subjectMetadata {
                         age
                     }, 
-                    tasks,
-                    dataProcessed
+                    tasks
                 }
             }
         }
     }
 }
 """.replace("\n", "")
-data = '{"query":"query testq{datasets ' + query + '}"}'
+datasets_query = "query testq($first: Int, $after: String) {datasets(first: $first, after: $after) %s}"
+page_query = datasets_query % query
+cursor_query = datasets_query % "{edges {cursor}}"
 
-response = requests.post("https://openneuro.org/crn/graphql", headers=headers, data=data)
-response = response.json()
 
-output = []
-# remember to remove duplicates
-while True:
-    for ds in response["data"]["datasets"]["edges"]:
-        if not ds:
-            continue
-        dataset_field = ds["node"]["latestSnapshot"]["dataset"]
-        summary_field = ds["node"]["latestSnapshot"]["summary"]
-        accession_number = ds["node"]["id"]
-        
+def body_prefix(graphql_query):
+    # The documents never change, so serialize them once and splice only the
+    # variables into each request body.
+    return orjson.dumps({"query": graphql_query})[:-1] + b',"variables":'
+
+
+page_body = body_prefix(page_query)
+cursor_body = body_prefix(cursor_query)
+
+
+def perform_query(data):
+    # Connection errors and 502/503/504s are retried by the adapter; this only
+    # retries bodies that are cut off or garbled after the response started.
+    for attempt in range(num_attempts):
         try:
-            dataset_made_public_datetime = datetime.strptime(
-                ds["node"]["publishDate"][:10], date_input_format
-            )
-            dataset_made_public = dataset_made_public_datetime.strftime(date_output_format)
-        except TypeError:
-            dataset_made_public_datetime = None
-        dataset_url = os.path.join(
-            "https://openneuro.org/datasets/",
-            accession_number,
-            "versions",
-            ds["node"]["latestSnapshot"]["tag"],
-        )
-        dataset_name = dataset_field["name"]
-        most_recent_snapshot_date = datetime.strptime(
-            ds["node"]["latestSnapshot"]["created"][:10],
-            date_input_format,
-        ).strftime(date_output_format)
-        if ds["node"]["latestSnapshot"]["size"]:
-            size_gb = round(ds["node"]["latestSnapshot"]["size"] / (1024**3), 2)
-        else:
-            size_gb = None
-        if summary_field is not None:
-            number_of_subjects = str(len(summary_field["subjects"]))
-            modalities_available = format_modalities(
-                summary_field["secondaryModalities"] + summary_field["modalities"]
-            )
-            ages = format_ages(summary_field["subjectMetadata"])
-            tasks_completed = ", ".join(summary_field["tasks"])
-        dx_status = dataset_field["metadata"]["dxStatus"]
-        number_of_trials = dataset_field["metadata"]["trialCount"]
-        study_design = dataset_field["metadata"]["studyDesign"]
-        domain_studied = dataset_field["metadata"]["studyDomain"]
-        longitudinal = (
-            "Yes" if dataset_field["metadata"]["studyLongitudinal"] == "Longitudinal" else "No"
-        )
-        processed_data = code_bool(dataset_field["metadata"],"dataProcessed")
-        species = dataset_field["metadata"]["species"]
-        nondefaced_consent =  code_bool(dataset_field["metadata"],"affirmedConsent")
-        affirmed_defaced = code_bool(dataset_field["metadata"],"affirmedDefaced")
-        doi_of_paper_associated_with_ds = dataset_field["metadata"]["associatedPaperDOI"]
-        doi_of_paper_because_ds_on_openneuro = dataset_field["metadata"]["openneuroPaperDOI"]
-        senior_author = format_name(ds["node"]["latestSnapshot"]["description"]["SeniorAuthor"])
-        line_raw = [
-            accession_number,
-            dataset_url,
-            dataset_name,
-            dataset_made_public,
-            most_recent_snapshot_date,
-            number_of_subjects,
-            modalities_available,
-            dx_status,
-            ages,
-            tasks_completed,
-            number_of_trials,
-            study_design,
-            domain_studied,
-            longitudinal,
-            processed_data,
-            species,
-            nondefaced_consent,
-            affirmed_defaced,
-            doi_of_paper_associated_with_ds,
-            doi_of_paper_because_ds_on_openneuro,
-            senior_author,
-            size_gb
-        ]
-        line = ["" if x is None else str(x) for x in line_raw]
-        output.append(line)
-
-    if len(response["data"]["datasets"]["edges"]) < 25:
-        break
-
-    next_cur = ds["cursor"]
-    data = f'{{"query": "query testq{{datasets(after: \\"{next_cur}\\") ' + query + '}"}'
-    response = requests.post(
-        "https://openneuro.org/crn/graphql",
-        headers=headers,
-        data=data,
-    )
-    response = response.json()
+            response = session.post(url, data=data, timeout=timeout)
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except (requests.exceptions.ChunkedEncodingError, orjson.JSONDecodeError):
+            if attempt == num_attempts - 1:
+                raise
+            time.sleep(backoff_factor * 2**attempt)
+
+
+def get_edges(body, first, after=None):
+    data = body + orjson.dumps({"first": first, "after": after}) + b"}"
+    return perform_query(data)["data"]["datasets"]["edges"]
+
+
+def get_page(after):
+    return get_edges(page_body, page_size, after)
+
+
+def get_page_cursors():
+    # Walk the listing with a cheap cursor-only query and yield the cursor that
+    # precedes each page as soon as it is seen, so the full page can be fetched
+    # concurrently while the walk carries on.
+    # A null edge leaves the previous cursor in place, which only makes two
+    # pages overlap; the duplicates are dropped when building the table.
+    yield None
+    cursor = None
+    position = 0
+    while True:
+        edges = get_edges(cursor_body, cursor_page_size, cursor)
+        for edge in edges:
+            position += 1
+            if edge:
+                cursor = edge["cursor"]
+            if position % page_size == 0:
+                yield cursor
+        if len(edges) < cursor_page_size:
+            break
+
 
 header = [
     "accession_number",
@@ -251,10 +229,105 @@ header = [
     "senior_author",
     "size_gb"
 ]
-df = pd.DataFrame(output, columns=header)
+integer_columns = {"num_subjects", "num_trials"}
+
+
+def append_row(columns, ds):
+    node = ds["node"]
+    snapshot = node["latestSnapshot"]
+    dataset_field = snapshot["dataset"]
+    metadata = dataset_field["metadata"]
+    summary_field = snapshot["summary"]
+    description_field = snapshot["description"]
+    accession_number = node["id"]
+    publish_date = node["publishDate"]
+    dataset_made_public = publish_date[:10] if publish_date else None
+    dataset_url = dataset_url_template.format(accession_number, snapshot["tag"])
+    dataset_name = dataset_field["name"]
+    most_recent_snapshot_date = snapshot["created"][:10]
+    size = snapshot["size"]
+    if size:
+        size_gb = round(size / (1024**3), 2)
+    else:
+        size_gb = None
+    if summary_field is not None:
+        number_of_subjects = len(summary_field["subjects"])
+        modalities_available = format_modalities(
+            summary_field["secondaryModalities"] + summary_field["modalities"]
+        )
+        ages = format_ages(summary_field["subjectMetadata"])
+        tasks_completed = ", ".join(summary_field["tasks"])
+    else:
+        number_of_subjects = None
+        modalities_available = None
+        ages = None
+        tasks_completed = None
+    dx_status = metadata["dxStatus"]
+    number_of_trials = metadata["trialCount"]
+    study_design = metadata["studyDesign"]
+    domain_studied = metadata["studyDomain"]
+    longitudinal = "Yes" if metadata["studyLongitudinal"] == "Longitudinal" else "No"
+    processed_data = bool_dict.get(metadata.get("dataProcessed"), "n/a")
+    species = metadata["species"]
+    nondefaced_consent = bool_dict.get(metadata.get("affirmedConsent"), "n/a")
+    affirmed_defaced = bool_dict.get(metadata.get("affirmedDefaced"), "n/a")
+    doi_of_paper_associated_with_ds = metadata["associatedPaperDOI"]
+    doi_of_paper_because_ds_on_openneuro = metadata["openneuroPaperDOI"]
+    if description_field is not None:
+        senior_author = format_name(description_field["SeniorAuthor"])
+    else:
+        senior_author = None
+    line_raw = [
+        accession_number,
+        dataset_url,
+        dataset_name,
+        dataset_made_public,
+        most_recent_snapshot_date,
+        number_of_subjects,
+        modalities_available,
+        dx_status,
+        ages,
+        tasks_completed,
+        number_of_trials,
+        study_design,
+        domain_studied,
+        longitudinal,
+        processed_data,
+        species,
+        nondefaced_consent,
+        affirmed_defaced,
+        doi_of_paper_associated_with_ds,
+        doi_of_paper_because_ds_on_openneuro,
+        senior_author,
+        size_gb
+    ]
+    for key, value in zip(header, line_raw):
+        if key in integer_columns:
+            columns[key].append(value)
+        else:
+            columns[key].append("" if value is None else str(value))
+
+
+columns = {key: [] for key in header}
+seen_accessions = set()
+executor = ThreadPoolExecutor(max_workers=num_workers)
+for edges in executor.map(get_page, get_page_cursors()):
+    for ds in edges:
+        if not ds or ds["node"]["id"] in seen_accessions:
+            continue
+        seen_accessions.add(ds["node"]["id"])
+        append_row(columns, ds)
+executor.shutdown()
+
+for key in integer_columns:
+    columns[key] = pd.array(columns[key], dtype="Int64")
+df = pd.DataFrame(columns)
+for date_column in ["made_public", "most_recent_snapshot"]:
+    df[date_column] = pd.to_datetime(
+        df[date_column], format=date_input_format, cache=True
+    ).dt.strftime(date_output_format)
 df = df.set_index("accession_number")
 df = df.sort_index()
-df = df.groupby(df.index).first()
-df.to_csv('metadata.csv', mode='w+')
+df.to_csv("metadata.csv", lineterminator="\n")
 
 